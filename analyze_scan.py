@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 
-"""Reads an image and lets the user click on positions of that image.  The
-resulting pixel cooredinates are returned to the calling process on stdout, in
-JSON format.  It is a list of four two-tuples, which represent the (x, y)
-coordinates of the four corners in arbitrary order.
+"""Reads images and lets the user click on positions of them.  The jobs are
+read from stdin, and the resulting pixel coordinates are returned to the
+calling process on stdout, both in JSON format, one line per batch of jobs.
+This way, Kivy is started only once for all images of a calibration.
 
-The command-line parameters are:
+Every line on stdin is a list of jobs.  A job is a list of
 
 - x coordinate of the ROI centre
 - y coordinate of the ROI centre
@@ -13,81 +13,290 @@ The command-line parameters are:
 - path to image
 - number of points to click
 
-The image can be any file format that ImageMagick can handle.
+For every line on stdin, one line is written to stdout.  It is a list with one
+item per job, namely the list of the clicked (x, y) coordinates.  The program
+exits when stdin is closed.
+
+The image can be any file format that ImageMagick can handle.  Binary PNM
+files, which is what Kamscan passes in, are cropped and scaled in-process.
 """
 
-import subprocess, json, sys, os, contextlib
+import subprocess, json, sys, os, contextlib, re, threading, functools, hashlib, concurrent.futures, traceback, tempfile
+import numpy
+os.environ["KIVY_NO_ARGS"] = "1"
 os.environ["KIVY_NO_FILELOG"] = "1"
 os.environ["KIVY_NO_CONSOLELOG"] = "1"
 os.environ["KIVY_NO_CONFIG"] = "1"
 with contextlib.redirect_stdout(None):
     from kivy.app import App
     from kivy.uix.image import Image
+    from kivy.graphics.texture import Texture
+    from kivy.clock import mainthread
+
+
+pnm_header_regex = re.compile(rb"(P[2356])" + 3 * rb"(?:\s|#[^\n]*\n)+(\d+)" + rb"\s")
+
+def read_pnm_header(path):
+    """Reads the header of a PNM file.
+
+    :param str path: path to the image file
+
+    :returns: magic number, width, height, maximal value, and the offset of the
+      pixel data in the file; ``None`` if the file is not a PNM file
+    :rtype: tuple[bytes, int, int, int, int] or NoneType
+    """
+    with open(path, "rb") as image_file:
+        match = pnm_header_regex.match(image_file.read(512))
+    if match:
+        magic_number, width, height, maximal_value = match.groups()
+        return magic_number, int(width), int(height), int(maximal_value), match.end()
+
+
+def shrink_pnm(path, x0, y0, width, height, scaling):
+    """Crops a region out of a binary PNM file and scales it down, without
+    calling an external program.  The region is clipped at the right and bottom
+    border of the image.  Scaling is done by averaging blocks of n×n pixels,
+    so the effective scaling is the reciprocal of an integer.  Averaging keeps
+    thin lines and marks visible, which plain subsampling could drop.  The
+    blocks are averaged one band of rows at a time, so that only a small part
+    of the file is in memory at once.  Pixels at the right and bottom border of
+    the region which do not fill a whole block are discarded.
+
+    16-bit files are assumed to contain linear, unscaled raw data, which is
+    very dark on screen.  Therefore, they are stretched so that the brightest
+    pixel of the region becomes white.
+
+    :param str path: path to the image file
+    :param int x0: x coordinate of the top left corner of the region
+    :param int y0: y coordinate of the top left corner of the region
+    :param int width: width of the region
+    :param int height: height of the region
+    :param float scaling: desired scaling
+
+    :returns: The RGB pixels of the scaled-down region with 8 bits per channel,
+      and the width and height of the region that it actually covers.  ``None``
+      if the file is not a binary PNM file.
+    :rtype: tuple[numpy.ndarray, int, int] or NoneType
+    """
+    header = read_pnm_header(path)
+    if not header or header[0] not in {b"P5", b"P6"}:
+        return None
+    magic_number, raw_width, raw_height, maximal_value, offset = header
+    channels = 3 if magic_number == b"P6" else 1
+    pixels = numpy.memmap(path, dtype=">u2" if maximal_value > 255 else "u1", mode="r", offset=offset,
+                          shape=(raw_height, raw_width, channels))
+    factor = max(1, round(1 / scaling))
+    width, height = min(width, raw_width - x0) // factor, min(height, raw_height - y0) // factor
+    tile = numpy.empty((height, width, channels), dtype=numpy.float32)
+    for row in range(height):
+        band = pixels[y0 + row * factor:y0 + (row + 1) * factor, x0:x0 + width * factor]
+        tile[row] = band.reshape(factor, width, factor, channels).mean(axis=(0, 2))
+    if maximal_value > 255:
+        tile *= 255 / max(tile.max(), 1)
+    elif maximal_value != 255:
+        tile *= 255 / maximal_value
+    tile = numpy.broadcast_to(tile.round(), (height, width, 3)).astype(numpy.uint8)
+    return tile, width * factor, height * factor
+
+
+@functools.lru_cache(maxsize=8)
+def make_tile(source, modification_time, x0, y0, crop_width, crop_height, scaling):
+    """Crops and scales a region of an image.  The result is cached, which is
+    why the modification time of the image must be passed, too.  Results of
+    the ImageMagick fallback are additionally kept on disk in `tile_directory`
+    under a name derived from the parameters, so that they survive eviction
+    from the in-memory cache.  The directory is removed when the program
+    exits.
+
+    :param str source: path to the image file
+    :param int modification_time: modification time of the image file in
+      nanoseconds; it is only used for the cache lookup
+    :param int x0: x coordinate of the top left corner of the region
+    :param int y0: y coordinate of the top left corner of the region
+    :param int crop_width: width of the region
+    :param int crop_height: height of the region
+    :param float scaling: desired scaling
+
+    :returns: The width and height of the region that is actually covered, and
+      the RGB pixels of the scaled-down region with 8 bits per channel.
+    :rtype: tuple[float, float, numpy.ndarray]
+    """
+    result = shrink_pnm(source, x0, y0, crop_width, crop_height, scaling)
+    if result:
+        tile, crop_width, crop_height = result
+        return crop_width, crop_height, tile
+    else:
+        key = hashlib.sha1(repr((source, modification_time, x0, y0, crop_width, crop_height, scaling)).encode())
+        path = os.path.join(tile_directory, key.hexdigest()[:16] + ".ppm")
+        if not os.path.exists(path):
+            # ImageMagick clips the crop region at the image borders by itself, so
+            # the size of the region is taken from the result.
+            subprocess.run(["convert", source, "-crop", f"{crop_width}x{crop_height}+{x0}+{y0}",
+                            "-filter", "Box", "-resize", f"{scaling * 100:g}%", path],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+                           env=dict(os.environ, MAGICK_THREAD_LIMIT="1"))
+        __, width, height, __, __ = read_pnm_header(path)
+        tile = shrink_pnm(path, 0, 0, width, height, 1)[0]
+        return width / scaling, height / scaling, tile
+
+
+def prepare_tile(x, y, scaling, source):
+    """Determines the region of the image to be shown for a job, and crops and
+    scales it.  The region is centred on the given coordinates and clamped at
+    the top left border of the image.
 
+    :param float x: x coordinate of the centre of the region
+    :param float y: y coordinate of the centre of the region
+    :param float scaling: desired scaling
+    :param str source: path to the image file
 
-class Result(Exception):
-    def __init__(self, points, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.points = points
+    :returns: The x and y coordinates of the top left corner of the region, the
+      width and height of the region that is actually covered, and the RGB
+      pixels of the scaled-down region with 8 bits per channel.
+    :rtype: tuple[int, int, float, float, numpy.ndarray]
+    """
+    half_width, half_height = 1100 / scaling / 2, 900 / scaling / 2
+    x0, y0 = max(0, int(x - half_width)), max(0, int(y - half_height))
+    crop_width, crop_height = int(x + half_width) - x0, int(y + half_height) - y0
+    return (x0, y0) + make_tile(source, os.stat(source).st_mtime_ns, x0, y0, crop_width, crop_height, scaling)
 
 
 class ImageWindow(Image):
+    """Shows a region of an image and collects the positions that the user clicks
+    on.  When all points of a job are clicked, the event ``on_points`` is
+    dispatched with the list of points.
+    """
 
-    def __init__(self, x, y, scaling, source, number_of_points, *args, **kwargs):
-        raw_width, raw_height = subprocess.check_output(["identify", source]).decode().split()[2].split("x")
-        raw_width, raw_height = int(raw_width), int(raw_height)
-        self.crop_width = min(raw_width, 1100 / scaling)
-        self.crop_height = min(raw_height, 900 / scaling)
-        self.x0 = x - self.crop_width / 2
-        self.y0 = y - self.crop_height / 2
-        if self.x0 < 0:
-            self.crop_width += self.x0
-            self.x0 = 0
-        if self.x0 + self.crop_width > raw_width:
-            self.crop_width = raw_width - self.x0
-        if self.y0 < 0:
-            self.crop_height += self.y0
-            self.y0 = 0
-        if self.y0 + self.crop_height > raw_height:
-            self.crop_height = raw_height - self.y0
-        subprocess.check_call(["convert", "-extract", "{}x{}+{}+{}".format(self.crop_width, self.crop_height,
-                                                                           self.x0, self.y0), source, "+repage",
-                               "-resize", "{}%".format(scaling * 100), "/tmp/analyze_scan.ppm"])
-        kwargs["source"] = "/tmp/analyze_scan.ppm"
-        super().__init__(*args, **kwargs)
+    def __init__(self, **kwargs):
+        self.register_event_type("on_points")
+        super().__init__(**kwargs)
+        self.bind(size=self.update_transform, norm_image_size=self.update_transform)
+
+    def update_transform(self, *args):
+        """Calculates the affine transformation from window coordinates to pixel
+        coordinates in the image.  It changes only if the window is resized or a
+        new region is shown, so it is not calculated anew for every click.
+        """
+        if self.texture:
+            image_width, image_height = self.norm_image_size
+            scale_x = self.crop_width / image_width
+            scale_y = self.crop_height / image_height
+            self.transform = (scale_x, self.x0 - (self.width - image_width) / 2 * scale_x,
+                              -scale_y, self.y0 + self.crop_height + (self.height - image_height) / 2 * scale_y)
+
+    def start(self, number_of_points, tile):
+        """Starts a new job.  Clicks are ignored until the region is shown.
+
+        :param int number_of_points: number of points to be clicked
+        :param concurrent.futures.Future tile: the result of `prepare_tile` for
+          this job
+        """
+        self.texture = None
         self.number_of_points = number_of_points
         self.points = []
+        tile.add_done_callback(self.tile_done)
+
+    def tile_done(self, tile):
+        """Shows the region once it is prepared.  If preparing it failed, the
+        application is stopped with an error, so that the calling process does
+        not wait forever.  This is called in the thread that prepared the region.
+
+        :param concurrent.futures.Future tile: the result of `prepare_tile`
+        """
+        error = tile.exception()
+        if error:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            App.get_running_app().fail()
+        else:
+            self.show_tile(*tile.result())
+
+    @mainthread
+    def show_tile(self, x0, y0, crop_width, crop_height, tile):
+        """Shows the cropped and scaled region.  The pixels are uploaded into a
+        texture directly, bypassing Kivy's image loaders.
+        """
+        self.x0, self.y0 = x0, y0
+        self.crop_width, self.crop_height = crop_width, crop_height
+        texture = Texture.create(size=tile.shape[1::-1], colorfmt="rgb")
+        texture.blit_buffer(tile.tobytes(), colorfmt="rgb", bufferfmt="ubyte")
+        texture.flip_vertical()
+        self.texture = texture
+        self.update_transform()
 
     def on_touch_down(self, touch):
-        image_width, image_height = self.norm_image_size
-        offset_x = (self.width - image_width) / 2
-        offset_y = (self.height - image_height) / 2
-        x = (touch.x - offset_x) * self.crop_width / image_width
-        y = self.crop_height - (touch.y - offset_y) * self.crop_height / image_height
-        self.points.append((int(x + self.x0), int(y + self.y0)))
+        if not self.texture:
+            return
+        scale_x, offset_x, scale_y, offset_y = self.transform
+        self.points.append((int(touch.x * scale_x + offset_x), int(touch.y * scale_y + offset_y)))
         if len(self.points) == self.number_of_points:
-            raise Result(self.points)
+            self.dispatch("on_points", self.points)
 
+    def on_points(self, points):
+        pass
 
-class AnalyzeApp(App):
 
-    def __init__(self, x, y, scaling, source, number_of_points, *args, **kwargs):
-        self.x = x
-        self.y = y
-        self.scaling = scaling
-        self.source = source
-        self.number_of_points = number_of_points
-        super().__init__(*args, **kwargs)
+class AnalyzeApp(App):
+    exit_code = 0
 
     def build(self):
-        return ImageWindow(self.x, self.y, self.scaling, self.source, self.number_of_points)
+        self.image_window = ImageWindow()
+        self.image_window.bind(on_points=self.job_done)
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+        self.jobs = []
+        self.results = []
+        return self.image_window
+
+    def on_start(self):
+        threading.Thread(target=self.read_jobs, daemon=True).start()
+
+    def read_jobs(self):
+        """Reads the lines of jobs from stdin.  This is called in its own thread,
+        so that the window stays responsive while the calling process prepares the
+        next line.  If stdin is closed, the application is stopped.
+        """
+        for line in sys.stdin:
+            self.start_jobs(json.loads(line))
+        mainthread(self.stop)()
+
+    @mainthread
+    def start_jobs(self, jobs):
+        """Starts a line of jobs.  The regions of all jobs are prepared in
+        parallel right away, so that the user does not have to wait for them
+        between the jobs.
+        """
+        self.jobs = [(number_of_points, self.executor.submit(prepare_tile, x, y, scaling, source))
+                     for x, y, scaling, source, number_of_points in jobs]
+        self.results = []
+        self.image_window.start(*self.jobs.pop(0))
+
+    def job_done(self, image_window, points):
+        """Takes the result of the current job and starts the next one.  If the
+        line of jobs is finished, the results are written to stdout.
+
+        :param ImageWindow image_window: the widget that dispatched the event
+        :param list[tuple[int, int]] points: the points clicked by the user
+        """
+        self.results.append(points)
+        if self.jobs:
+            self.image_window.start(*self.jobs.pop(0))
+        else:
+            print(json.dumps(self.results), flush=True)
+
+    @mainthread
+    def fail(self):
+        """Stops the application with a non-zero exit code.
+        """
+        self.exit_code = 1
+        self.stop()
+
 
-    def run(self):
-        try:
-            super().run()
-        except Result as result:
-            return result.points
+def main():
+    global tile_directory
+    app = AnalyzeApp()
+    with tempfile.TemporaryDirectory(prefix="analyze_scan-") as tile_directory:
+        app.run()
+    sys.exit(app.exit_code)
 
 
-result = AnalyzeApp(int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3]), sys.argv[4], int(sys.argv[5])).run()
-json.dump(result, sys.stdout)
+if __name__ == "__main__":
+    main()
@@ -7,30 +7,21 @@ This script must reside in the same directory as its helpers ``undistort`` and
 ``analyze_scan.py``.  It requires Python 3.5.
 """
 
-import argparse, pickle, time, os, tempfile, shutil, subprocess, json, multiprocessing, datetime, re, functools, importlib
+import argparse, time, os, tempfile, shutil, json, subprocess, datetime, re, importlib, itertools
+import multiprocessing, concurrent.futures
 from contextlib import contextmanager
 from pathlib import Path
-import pytz, argcomplete
-from ruamel.yaml import YAML
-import undistort
 from . import utils
 from .utils import silent_call
 
-
-yaml = YAML()
-
-try:
-    configuration = yaml.load(Path.home()/".config/kamscan/configuration.yaml")
-except FileNotFoundError:
-    configuration = {}
+# NumPy, tifffile, pikepdf, pytz, ruamel.yaml, and undistort are imported in
+# the functions that need them, so that e.g. “--help” and the shell completion
+# do not load them.
 
 
 formats = {"A2": (42, 59.4), "A3": (29.7, 42), "A4": (21, 29.7), "A5": (14.8, 21), "A6": (10.5, 14.8), "A7": (7.4, 10.5)}
 
 
-data_root = Path(configuration["data_path"]) if "data_path" in configuration else Path.home()/".config/kamscan"
-profiles_root = data_root/"profiles"
-
 parser = argparse.ArgumentParser(description="Scan a document.")
 parser.add_argument("--calibration", action="store_true", help="force taking a calibration image")
 parser.add_argument("--mode", default="mono", choices={"gray", "color", "mono"},
@@ -50,18 +41,15 @@ parser.add_argument("--full-histogram", action="store_true", help="don’t do an
 parser.add_argument("--no-ocr", action="store_true", help="suppress OCR (much faster)")
 parser.add_argument("filepath", type=Path, help="path to the PDF file for storing; name without extension must match "
                     "YYYY-MM-DD_Title")
-parser.add_argument("--source", default=configuration["default_source"], help="name of the images source")
+parser.add_argument("--source", help="name of the images source; defaults to \"default_source\" in the configuration")
 parser.add_argument("--params",
                     help="parameters of the images source; may have the form --param VAL or --param PAR1=VAL1,PAR2=VAL2")
-argcomplete.autocomplete(parser)
-args = parser.parse_args()
 
-utils.debug = args.debug
 
-def parse_source_parameters():
-    if not args.params or not args.params.strip():
+def parse_source_parameters(params):
+    if not params or not params.strip():
         return None
-    pairs = args.params.split(",")
+    pairs = params.split(",")
     parameters = {}
     for pair in pairs:
         pair = pair.strip()
@@ -71,54 +59,52 @@ def parse_source_parameters():
             return pair
         parameters[key.strip()] = value.strip()
     return parameters
-source_parameters = parse_source_parameters()
 
-assert "/" not in args.profile
-profile_root = profiles_root/args.profile
 
-if args.full_height is None:
-    page_height = 29.7
-elif args.calibration:
-    page_height = args.full_height
-else:
-    raise RuntimeError("You can give --full-height only with --calibration.")
+filename_regex = re.compile(r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})_(?P<title>.*)$")
 
-assert args.filepath.parent.is_dir()
+own_directory = Path(__file__).parent.resolve()
+
+def available_memory():
+    """Returns the amount of memory that is available without swapping.
+
+    :returns: available memory in bytes
+    :rtype: int
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def shared_memory_directory(page_size, workers):
+    """Returns the directory for temporary files which are the intermediate
+    images of the pages.  They are large and each of them is read and written
+    several times, so a RAM-backed file system is used if available.  The
+    intermediate files of a page are removed as soon as the page is done, so
+    that nothing accumulates there.  The raw images and the PDFs of the pages
+    are kept on disk.
+
+    This is decided once for the whole scan.  The RAM-backed file system is
+    only used if both its free space and the available memory suffice for
+    the intermediate files of all pages that are processed at the same time.
+
+    :param int page_size: upper bound of the size of the intermediate files of
+      one page in bytes
+    :param int workers: number of pages that are processed at the same time
+
+    :returns: path to a RAM-backed directory, or ``None`` if there is none with
+      enough space; the latter means the system default
+    :rtype: str or NoneType
+    """
+    needed = page_size * workers
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free >= needed and available_memory() >= needed:
+        return "/dev/shm"
 
-if args.format:
-    assert args.width is None and args.height is None
-    if args.two_side:
-        height_in_cm, width_in_cm = formats[args.format]
-    else:
-        width_in_cm, height_in_cm = formats[args.format]
-else:
-    width_in_cm, height_in_cm = args.width, args.height
-
-match = re.match(r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})_(?P<title>.*)$", args.filepath.stem)
-if match:
-    year, month, day = int(match.group("year")), int(match.group("month")), int(match.group("day"))
-    if year == 0:
-        year, month, day = 1970, 1, 1
-        timestamp_accuracy = "none"
-    elif month == 0:
-        month, day = 1, 1
-        timestamp_accuracy = "year"
-    elif day == 0:
-        day = 1
-        timestamp_accuracy = "month"
-    else:
-        timestamp_accuracy = "full"
-    timestamp = datetime.datetime(year, month, day, tzinfo=pytz.UTC)
-    title = match.group("title").replace("_", " ")
-else:
-    raise RuntimeError("Invalid format for filepath.  Must be YYYY-MM-DD_Title.pdf.")
-
-try:
-    profile_data = configuration["sources"][args.source]["icc_profile"]
-except KeyError:
-    icc_path, icc_color_space = None, "RGB"
-else:
-    icc_path, icc_color_space = Path(profile_data["path"]), profile_data["color_space"]
 
 def path_to_own_file(name):
     """Returns the path to a file which resides in the same directory as this
@@ -129,7 +115,7 @@ def path_to_own_file(name):
     :returns: full path to the file
     :rtype: Path
     """
-    return (Path(__file__).parent/name).resolve()
+    return own_directory/name
 
 
 def append_to_path_stem(path, suffix):
@@ -149,12 +135,12 @@ def append_to_path_stem(path, suffix):
     :returns: path with the suffix appended
     :rtype: pathlib.Path
     """
-    return (path.parent/(path.stem + suffix)).with_suffix(path.suffix)
+    return path.with_name(path.stem + suffix + path.suffix)
 
 
 def datetime_to_pdf(timestamp, timestamp_accuracy="full"):
-    """Converts a timestamp to the format used by PDFtk in its `update_info`
-    command.  For example, the timestamp 2017-09-01 14:23:45 CEDT is converted
+    """Converts a timestamp to the date format of the PDF document information
+    dictionary.  For example, the timestamp 2017-09-01 14:23:45 CEDT is converted
     to ``D:20170901142345+02'00'``.
 
     :param datetime.datetime timestamp: the timestamp
@@ -178,13 +164,9 @@ def datetime_to_pdf(timestamp, timestamp_accuracy="full"):
     return timestamp
 
 
-source_module = importlib.import_module(".sources." + args.source, "kamscan")
-source = source_module.Source(configuration["sources"][args.source], source_parameters)
-
-
 class CorrectionData:
     """Class holding data that belongs to an image calibration.  This data is part
-    of a profile.  It is stored in the pickle file in the profile's directory.
+    of a profile.  It is stored in the JSON file in the profile's directory.
 
     :var coordinates: The pixel coordinates of the rectangle measured during
       the calibration.  Note that this rectangle needn't necessarily be the
@@ -193,15 +175,21 @@ class CorrectionData:
       they can be even larger than the rectangle.  The four corners are stored
       in the order top left, top right, bottom left, bottom right.  First the x
       coordinate, then the y coordinate.
-    :vartype coodinates: list[int]
+    :vartype coordinates: list[int]
 
     :var float height_in_cm: the real-world height (i.e., dimension in y
       direction) of the rectangle given by `coordinates` in centimetres.
     """
+    __slots__ = ("coordinates", "height_in_cm", "camera", "lens")
 
-    def __init__(self):
+    def __init__(self, height_in_cm):
+        """Class constructor.
+
+        :param float height_in_cm: the real-world height of the calibration
+          rectangle in centimetres
+        """
         self.coordinates = 8 * [None]
-        self.height_in_cm = page_height
+        self.height_in_cm = height_in_cm
         self.camera = None
         self.lens = None
 
@@ -216,6 +204,31 @@ class CorrectionData:
         """
         return height_in_pixel / (self.height_in_cm / 2.54)
 
+    def to_dict(self):
+        """Returns the data of this object as a dictionary that can be serialised
+        to JSON.
+
+        :returns: the data of this object
+        :rtype: dict[str, object]
+        """
+        return {"coordinates": self.coordinates, "height_in_cm": self.height_in_cm,
+                "camera": self.camera, "lens": self.lens}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates an object from a dictionary as returned by `to_dict`.
+
+        :param dict[str, object] data: the data of the object
+
+        :returns: the new object
+        :rtype: CorrectionData
+        """
+        correction_data = cls(data["height_in_cm"])
+        correction_data.coordinates = data["coordinates"]
+        correction_data.camera = data["camera"]
+        correction_data.lens = data["lens"]
+        return correction_data
+
     def __repr__(self):
         """Returns a string representation of this object.  This is used only for
         debugging purposes.
@@ -227,25 +240,161 @@ class CorrectionData:
             "Kamera: '{}'  Objektiv: '{}'".format(*(self.coordinates + [self.camera, self.lens]))
 
 
-def analyze_scan(x, y, scaling, filepath, number_of_points):
-    """Lets the user find the four corners of the calibration rectangle.
+class Context:
+    """Class holding the state of a scan, as derived from the command line and
+    the configuration.  It is created once by `main` and passed to all
+    functions that need it, including those running in the worker processes.
+
+    :var argparse.Namespace args: the command line arguments
+    :var dict[str, object] configuration: global configuration, as read from
+      ``configuration.yaml``
+    :var pathlib.Path profiles_root: directory with all profiles
+    :var pathlib.Path profile_root: directory of the current profile
+    :var pathlib.Path calibration_file_path: path to the JSON file with the
+      correction data of the current profile
+    :var float page_height: real-world height of the calibration rectangle in
+      centimetres
+    :var crop_width_in_cm: real-world width of the crop area in centimetres;
+      ``None`` means the width of the calibration rectangle
+    :vartype crop_width_in_cm: float or NoneType
+    :var crop_height_in_cm: real-world height of the crop area in centimetres;
+      ``None`` means the height of the calibration rectangle
+    :vartype crop_height_in_cm: float or NoneType
+    :var datetime.datetime timestamp: creation timestamp of the document
+    :var str timestamp_accuracy: significant parts of `timestamp`, see
+      `datetime_to_pdf`; additionally, it may be ``"none"``
+    :var str title: title of the document
+    :var icc_path: path to the ICC profile of the camera, if any
+    :vartype icc_path: pathlib.Path or NoneType
+    :var str icc_color_space: ImageMagick name of the profile's PCS
+    :var source: the images source
+    :var pathlib.Path flatfield_path: path to the flat field of the current
+      profile for the colour mode
+    :var CorrectionData correction_data: correction data of the current
+      profile; it is set by `main` after the calibration
+    :var work_directory: directory for the intermediate files of the pages, see
+      `shared_memory_directory`; it is set by `main` after the calibration
+    :vartype work_directory: str or NoneType
+    """
+
+    def __init__(self, args):
+        """Class constructor.
+
+        :param argparse.Namespace args: the command line arguments
 
-    :returns: Pixel coordinates of the four corners of the calibration
-      rectangle.  They are returned in no particular order.
-    :rtype: list[tuple[int, int]]
+        :raises RuntimeError: if the command line arguments are inconsistent
+        """
+        from ruamel.yaml import YAML
+        import pytz
+        self.args = args
+        yaml = YAML(typ="safe")
+        try:
+            self.configuration = yaml.load(Path.home()/".config/kamscan/configuration.yaml")
+        except FileNotFoundError:
+            self.configuration = {}
+
+        if args.source is None:
+            args.source = self.configuration["default_source"]
+
+        data_root = Path(self.configuration["data_path"]) if "data_path" in self.configuration else \
+            Path.home()/".config/kamscan"
+        self.profiles_root = data_root/"profiles"
+
+        assert "/" not in args.profile
+        self.profile_root = self.profiles_root/args.profile
+        self.calibration_file_path = self.profile_root/"calibration.json"
+        self.flatfield_path = (self.profile_root/"flatfield").with_suffix(
+            ".pgm" if args.mode in {"gray", "mono"} else ".ppm")
+
+        if args.full_height is None:
+            self.page_height = 29.7
+        elif args.calibration:
+            self.page_height = args.full_height
+        else:
+            raise RuntimeError("You can give --full-height only with --calibration.")
+
+        assert args.filepath.parent.is_dir()
+
+        # In two-side mode, the image of the double page is rotated, so the
+        # width of the crop is the height of the page, and vice versa.
+        if args.format:
+            assert args.width is None and args.height is None
+            self.crop_width_in_cm, self.crop_height_in_cm = formats[args.format]
+        elif args.two_side:
+            self.crop_width_in_cm, self.crop_height_in_cm = args.height, args.width
+        else:
+            self.crop_width_in_cm, self.crop_height_in_cm = args.width, args.height
+
+        match = filename_regex.match(args.filepath.stem)
+        if match:
+            year, month, day = int(match.group("year")), int(match.group("month")), int(match.group("day"))
+            if year == 0:
+                year, month, day = 1970, 1, 1
+                self.timestamp_accuracy = "none"
+            elif month == 0:
+                month, day = 1, 1
+                self.timestamp_accuracy = "year"
+            elif day == 0:
+                day = 1
+                self.timestamp_accuracy = "month"
+            else:
+                self.timestamp_accuracy = "full"
+            self.timestamp = datetime.datetime(year, month, day, tzinfo=pytz.UTC)
+            self.title = match.group("title").replace("_", " ")
+        else:
+            raise RuntimeError("Invalid format for filepath.  Must be YYYY-MM-DD_Title.pdf.")
+
+        source_configuration = self.configuration["sources"][args.source]
+        try:
+            profile_data = source_configuration["icc_profile"]
+        except KeyError:
+            self.icc_path, self.icc_color_space = None, "RGB"
+        else:
+            self.icc_path, self.icc_color_space = Path(profile_data["path"]), profile_data["color_space"]
+
+        source_module = importlib.import_module(".sources." + args.source, "kamscan")
+        self.source = source_module.Source(source_configuration, parse_source_parameters(args.params))
+        self.correction_data = None
+        self.work_directory = None
+
+
+@contextmanager
+def scan_analyzer():
+    """Starts the external helper ``analyze_scan.py`` which lets the user click on
+    positions in images.  It is started only once, so that all images of a
+    calibration are shown by the same process.
+
+    :returns: A function which takes a list of jobs and returns one list of
+      clicked pixel coordinates per job, in the order of the jobs.  A job is a
+      tuple ``(x, y, scaling, filepath, number_of_points)``, with ``x`` and ``y``
+      as the centre of the region to be shown.
+    :rtype: function
     """
     def clamp(x, max_):
         return min(max(x, 0), max_ - 1)
-    output = silent_call([path_to_own_file("analyze_scan.py"), clamp(x, 4000), clamp(y, 6000), scaling,
-                          filepath, number_of_points], swallow_stdout=False).stdout
-    result = json.loads(output)
-    return result
+    def analyze(jobs):
+        jobs = [(clamp(x, 4000), clamp(y, 6000), scaling, str(filepath), number_of_points)
+                for x, y, scaling, filepath, number_of_points in jobs]
+        analyzer.stdin.write(json.dumps(jobs) + "\n")
+        analyzer.stdin.flush()
+        line = analyzer.stdout.readline()
+        if not line:
+            raise RuntimeError("analyze_scan.py terminated unexpectedly.")
+        return json.loads(line)
+    analyzer = silent_call([path_to_own_file("analyze_scan.py")], asynchronous=True, swallow_stdout=False,
+                           pipe_stdin=True, text=True)
+    try:
+        yield analyze
+    finally:
+        analyzer.stdin.close()
+        analyzer.wait()
 
-def analyze_calibration_image():
+
+def analyze_calibration_image(context):
     """Takes one or two calibration images from the camera and creates a profile
     from them.  Such a profile consists of three files:
 
-    - pickle file with the correction data
+    - JSON file with the correction data
     - PPM file with the colour flat field
     - PGM file with the greyscale flat field (also used for the monochromatic
       mode)
@@ -258,21 +407,22 @@ def analyze_calibration_image():
     image is provided, is serves both, i.e. is must be an empty white sheet of
     paper.
 
+    :param Context context: the state of the scan
+
     :returns: correction data for this scan
     :rtype: CorrectionData
 
     :raises RuntimeError: if more than two calibration images were found on the
-      camera storage, or none
+      camera storage, or none; or if the clicked points do not lie in the four
+      quadrants around their centre
     """
-    def get_points(path):
-        temp_path = append_to_path_stem(path, "-unraw")
-        # For avoiding a race with the flat field PPM generation.
-        os.symlink(str(path), str(temp_path))
-        ppm_path = source.raw_to_pnm(temp_path, for_preview=True)
-        raw_points = analyze_scan(2000, 3000, 0.1, ppm_path, 4)
-        return [analyze_scan(x, y, 1, ppm_path, 1)[0] for x, y in raw_points]
+    def get_points(pnm_path):
+        with scan_analyzer() as analyze:
+            raw_points, = analyze([(2000, 3000, 0.1, pnm_path, 4)])
+            return [points[0] for points in analyze([(x, y, 1, pnm_path, 1) for x, y in raw_points])]
     with tempfile.TemporaryDirectory() as tempdir:
         tempdir = Path(tempdir)
+        source = context.source
         for index, last_page, path in source.images(tempdir, for_calibration=True):
             if index > 1:
                 raise RuntimeError("More than two calibration images found.")
@@ -280,57 +430,62 @@ def analyze_calibration_image():
                 path_color, dcraw_color = source.raw_to_pnm(path, asynchronous=True)
                 path_gray, dcraw_gray = source.raw_to_pnm(path, gray=True, asynchronous=True)
             if last_page:
-                points = get_points(path)
+                if index == 0:
+                    # The colour flat field is the very same picture, so it
+                    # can be shown instead of a preview conversion.
+                    assert dcraw_color.wait() == 0
+                    points = get_points(path_color)
+                else:
+                    points = get_points(source.raw_to_pnm(path, for_preview=True))
         assert dcraw_color.wait() == 0
         assert dcraw_gray.wait() == 0
-        shutil.move(str(path_color), str(profile_root/"flatfield.ppm"))
-        shutil.move(str(path_gray), str(profile_root/"flatfield.pgm"))
-    correction_data = CorrectionData()
+        shutil.move(str(path_color), str(context.profile_root/"flatfield.ppm"))
+        shutil.move(str(path_gray), str(context.profile_root/"flatfield.pgm"))
     center_x = sum(point[0] for point in points) / len(points)
     center_y = sum(point[1] for point in points) / len(points)
-    for point in points:
-        if point[0] < center_x:
-            if point[1] < center_y:
-                correction_data.coordinates[0:2] = point
-            else:
-                correction_data.coordinates[4:6] = point
-        else:
-            if point[1] < center_y:
-                correction_data.coordinates[2:4] = point
-            else:
-                correction_data.coordinates[6:8] = point
+    corners = {(x >= center_x) + 2 * (y >= center_y): (x, y) for x, y in points}
+    if len(corners) != 4:
+        raise RuntimeError("The clicked points are not the four corners of a rectangle.")
+    correction_data = CorrectionData(context.page_height)
+    correction_data.coordinates = [coordinate for index in range(4) for coordinate in corners[index]]
     return correction_data
 
 
-def prune_profiles():
+def prune_profiles(profiles_root):
     """Removes profiles that are older than 5 o'clock of today, and at least 4
     hours old.
+
+    :param pathlib.Path profiles_root: directory with all profiles
     """
-    if profiles_root.exists():
-        now = datetime.datetime.now()
-        minutes = (now.hour * 60 + now.minute - 5 * 60) % (24 * 60)
-        minutes = max(minutes, 4 * 60)
-        directories = subprocess.run(["find", profiles_root, "-mindepth", "1", "-maxdepth", "1",
-                                      "-mmin", "+{}".format(minutes), "-type", "d", "-print0"],
-                                     check=True, text=True, capture_output=True).stdout.split("\x00")[:-1]
-        for directory in directories:
-            shutil.rmtree(directory)
-prune_profiles()
-os.makedirs(str(profile_root), exist_ok=True)
-calibration_file_path = profile_root/"calibration.pickle"
-
-def get_correction_data():
+    now = datetime.datetime.now()
+    minutes = (now.hour * 60 + now.minute - 5 * 60) % (24 * 60)
+    minutes = max(minutes, 4 * 60)
+    threshold = time.time() - minutes * 60
+    try:
+        with os.scandir(profiles_root) as entries:
+            directories = [entry.path for entry in entries
+                           if entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < threshold]
+    except FileNotFoundError:
+        return
+    for directory in directories:
+        shutil.rmtree(directory)
+
+
+def get_correction_data(context):
     """Returns the correction data for the current profile.  If such data does not
     yet exist on disk, the user gets the opportunity to provide the necessary
     input for it (taking calibration images, click on corners).  The result of
     this is stored on disk.
 
+    :param Context context: the state of the scan
+
     :returns: correction data for the current profile
     :rtype: CorrectionData
     """
     print("Calibration is necessary.  First the flat field, then for the position, or one image for both …")
-    correction_data = analyze_calibration_image()
-    source_configuration = configuration["sources"][args.source]
+    correction_data = analyze_calibration_image(context)
+    configuration = context.configuration
+    source_configuration = configuration["sources"][context.args.source]
 
     correction_data.camera = [source_configuration["make"], source_configuration["model"]]
 
@@ -345,19 +500,11 @@ def get_correction_data():
             correction_data.lens = [lens["make"], lens["model"]]
             break
 
-    pickle.dump(correction_data, open(str(calibration_file_path), "wb"))
+    context.calibration_file_path.write_text(json.dumps(correction_data.to_dict()))
     return correction_data
 
-if args.calibration:
-    correction_data = get_correction_data()
-else:
-    try:
-        correction_data = pickle.load(open(str(calibration_file_path), "rb"))
-    except FileNotFoundError:
-        correction_data = get_correction_data()
-
 
-def raw_to_corrected_pnm(filepath):
+def raw_to_corrected_pnm(context, filepath, work_path):
     """Converts a RAW file into a corrected PNM file.  The applied corrections are:
 
     1. Vignetting
@@ -382,29 +529,34 @@ def raw_to_corrected_pnm(filepath):
     this rectangle is known, this enables the software to crop the image
     properly to the the desired page.
 
+    :param Context context: the state of the scan
     :param pathlib.Path filepath: path to the RAW file
+    :param pathlib.Path work_path: directory where the PNM file is written to
 
     :returns: path to the PNM file, coordinates of the full page's origin, and
       its width and height; all in pixels from the top left
     :rtype: pathlib.Path, float, float, float, float
     """
-    filepath = source.raw_to_pnm(filepath, gray=args.mode in {"gray", "mono"}, b=0.9)
-    flatfield_path = (profile_root/"flatfield").with_suffix(".pgm" if args.mode in {"gray", "mono"} else ".ppm")
-    tempfile = append_to_path_stem(filepath, "-temp")
-    silent_call(["convert", filepath, flatfield_path, "-compose", "dividesrc", "-composite", tempfile])
-    os.rename(str(tempfile), str(filepath))
-    x0, y0, width, height = undistort.undistort(str(filepath), *(correction_data.coordinates +
-                                                                 correction_data.camera + correction_data.lens))
+    import undistort
+    correction_data = context.correction_data
+    filepath = context.source.raw_to_pnm(filepath, gray=context.args.mode in {"gray", "mono"}, b=0.9,
+                                         output_directory=work_path)
+    x0, y0, width, height = undistort.undistort(str(filepath), str(context.flatfield_path),
+                                                *(correction_data.coordinates + correction_data.camera +
+                                                  correction_data.lens))
     return filepath, x0, y0, width, height
 
 
-def calculate_pixel_dimensions(width, height):
+def calculate_pixel_dimensions(context, width, height):
     """Returns the pixel width and height of the page rectangle, and the DPI.  This
     is the page rectangle rather than the calibration rectangle, i.e. the
     ``--width`` and ``--height`` parameters (or the ``--format`` parameter, or
     the full page size as default) are used.  The returned dimensions denote
-    the area that needs to be cropped out of the original image.
+    the area that needs to be cropped out of the original image.  Their
+    real-world size is given by the attributes `crop_width_in_cm` and
+    `crop_height_in_cm` of the context.
 
+    :param Context context: the state of the scan
     :param float width: width of the calibration rectangle in pixels
     :param float height: height of the calibration rectangle in pixels
 
@@ -412,59 +564,129 @@ def calculate_pixel_dimensions(width, height):
       DPI
     :rtype: float, float, float
     """
-    density = correction_data.density(height)
-    if args.two_side:
-        if height_in_cm is not None:
-            width = height_in_cm / 2.54 * density
-        if width_in_cm is not None:
-            height = width_in_cm / 2.54 * density
-    else:
-        if height_in_cm is not None:
-            height = height_in_cm / 2.54 * density
-        if width_in_cm is not None:
-            width = width_in_cm / 2.54 * density
+    density = context.correction_data.density(height)
+    if context.crop_width_in_cm is not None:
+        width = context.crop_width_in_cm / 2.54 * density
+    if context.crop_height_in_cm is not None:
+        height = context.crop_height_in_cm / 2.54 * density
     return width, height, density
 
 
-@functools.lru_cache(maxsize=2)
-def get_levels(path):
+def luma(pixels):
+    """Returns the luma of an image.  Colour images are reduced to their
+    Rec. 709 luma.
+
+    :param numpy.ndarray pixels: the pixels as returned by `create_crops`
+
+    :returns: the luma of every pixel, from 0 to 1
+    :rtype: numpy.ndarray
+    """
+    import numpy
+    factor = numpy.float32(1 / numpy.iinfo(pixels.dtype).max)
+    if pixels.ndim == 3:
+        return pixels @ numpy.array([0.2126, 0.7152, 0.0722], dtype=numpy.float32) * factor
+    else:
+        return pixels * factor
+
+
+def get_levels(pixels):
     """Returns the black and white levels for this image.  This corresponds to
     Imagemagick convert's command ``-linear-stretch 2%x1%``.  The result could
-    be passed to ``-level``.  The reason why this is necessary is that pages
+    be passed to `level`.  The reason why this is necessary is that pages
     with very little text confuse ``-linear-stretch``.  It blacks out too much
     of the page, resulting is way too high contrast.  In contrast, this
     function caps the black result to 0.15.
 
-    :param pathlib.Path path: path to the image file
+    :param numpy.ndarray pixels: grey values from 0 to 1
 
     :returns: the black and white level, as fraction of 1
     :rtype: float, float
     """
-    line_regex = re.compile(r"(?P<frequency>\d+): \(\s*\d+,\s*\d+,\s*\d+\) #[A-F0-9]{6} gray\((?P<value>\d+)\)$")
-    frequencies = 256 * [0]
-    for line in silent_call(["convert", path, "-colorspace", "gray", "-depth", "8", "-format", "%c", "histogram:info:-"],
-                            swallow_stdout=False).stdout.splitlines():
-        match = line_regex.match(line.strip())
-        value, frequency = int(match.group("value")), int(match.group("frequency"))
-        frequencies[value] += frequency
-    number_of_samples = sum(frequencies)
-    darkest_2_percent = 0
-    for i, frequency in enumerate(frequencies):
-        darkest_2_percent += frequency
-        if darkest_2_percent > number_of_samples * 0.02:
-            break
-    brightest_1_percent = 0
-    for j, frequency in enumerate(reversed(frequencies)):
-        brightest_1_percent += frequency
-        if brightest_1_percent > number_of_samples * 0.01:
-            break
+    import numpy
+    frequencies = numpy.bincount(to_8_bit(pixels).ravel(), minlength=256)
+    number_of_samples = pixels.size
+    i = numpy.searchsorted(numpy.cumsum(frequencies), number_of_samples * 0.02, side="right")
+    j = numpy.searchsorted(numpy.cumsum(frequencies[::-1]), number_of_samples * 0.01, side="right")
     return min(i / 255, 0.15), 1 - j / 255
 
 
-def create_crop(filepath, width, height, x0, y0):
-    """Crops the scan area out of the out-of-camera PNM file and saves it as a TIFF
-    file.
+def level(pixels, black, white):
+    """Stretches the grey values linearly so that `black` becomes 0 and `white`
+    becomes 1.  Values outside are clipped.  This corresponds to ImageMagick
+    convert's command ``-level``.
+
+    :param numpy.ndarray pixels: grey values from 0 to 1
+    :param float black: black level, as fraction of 1
+    :param float white: white level, as fraction of 1
+
+    :returns: the stretched grey values
+    :rtype: numpy.ndarray
+    """
+    import numpy
+    return numpy.clip((pixels - numpy.float32(black)) * numpy.float32(1 / (white - black)), 0, 1)
+
+
+def to_8_bit(pixels):
+    """Converts grey values to 8 bit.
+
+    :param numpy.ndarray pixels: grey values from 0 to 1
+
+    :returns: grey values from 0 to 255
+    :rtype: numpy.ndarray
+    """
+    import numpy
+    return numpy.rint(pixels * numpy.float32(255)).astype(numpy.uint8)
+
+
+def encode_srgb(pixels, black):
+    """Levels linear pixel values and encodes them as 8-bit sRGB.  This
+    corresponds to ImageMagick convert's ``-level`` followed by ``-depth 8
+    -colorspace sRGB``.  It is done with a lookup table over all 16-bit
+    values, so that every pixel is touched only once.
+
+    :param numpy.ndarray pixels: linear pixel values with 16 bits
+    :param float black: black level, as fraction of 1
+
+    :returns: the sRGB pixel values with 8 bits
+    :rtype: numpy.ndarray
+    """
+    import numpy
+    values = level(numpy.arange(65536, dtype=numpy.float32) * numpy.float32(1 / 65535), black, 1)
+    values = numpy.where(values <= 0.0031308, 12.92 * values, 1.055 * values ** (1 / 2.4) - 0.055)
+    return to_8_bit(values)[pixels]
+
+
+pnm_header_regex = re.compile(rb"(P[56])" + 3 * rb"(?:\s|#[^\n]*\n)+(\d+)" + rb"\s")
+
+def read_pnm(filepath):
+    """Maps a binary PNM file into memory.
 
+    :param pathlib.Path filepath: path to the PNM file
+
+    :returns: the pixels; the shape is (height, width) for PGM and (height,
+      width, 3) for PPM files
+    :rtype: numpy.ndarray
+    """
+    import numpy
+    with open(str(filepath), "rb") as pnm_file:
+        match = pnm_header_regex.match(pnm_file.read(512))
+    magic_number, width, height, maximal_value = match.groups()
+    shape = (int(height), int(width)) + ((3,) if magic_number == b"P6" else ())
+    return numpy.memmap(str(filepath), dtype=">u2" if int(maximal_value) > 255 else "u1", mode="r",
+                        offset=match.end(), shape=shape)
+
+
+def create_crops(context, page_index, last_page, filepath, width, height, x0, y0):
+    """Crops the scan area out of the out-of-camera PNM file.  In two-side mode,
+    the scan area is split into the two pages, see `split_two_side`.  The
+    crops are copied into memory, so the PNM file may be deleted afterwards.
+    The black and white levels are determined from the whole scan area, so
+    that both pages of a double page get the same levels.
+
+    :param Context context: the state of the scan
+    :param int page_index: Index of the current page.  In two-side mode, this
+      is the index of the current double page.
+    :param bool last_page: whether it is the last page
     :param pathlib.Path filepath: path to the corrected PNM file; it is the
       result of `raw_to_corrected_pnm`
     :param float width: pixel width of the crop area
@@ -472,20 +694,35 @@ def create_crop(filepath, width, height, x0, y0):
     :param float x0: x pixel coordinate of the top left corner of the crop area
     :param float y0: y pixel coordinate of the top left corner of the crop area
 
-    :returns: path to the result image
-    :rtype: pathlib.Path
+    :returns: TIFF paths for the result images, from which the names of all
+      further files of the page are derived, and their pixels; in two-side
+      mode, these are the pages in the ordering left, right, otherwise, it is
+      one page; and the black and white levels of the scan area, see
+      `get_levels`
+    :rtype: list[tuple[pathlib.Path, numpy.ndarray]], tuple[float, float]
     """
-    filepath_tiff = filepath.with_suffix(".tiff")
-    silent_call(["convert", "-extract", "{}x{}+{}+{}".format(width, height, x0, y0), "+repage", filepath, filepath_tiff])
-    return filepath_tiff
-
-
-def color_process_single_tiff(filepath, density, mode, suffix):
-    """Applies some colour optimisation and puts the proper DPI value in the
-    output's metadata.
-
-    :param pathlib.Path filepath: path to the cropped TIFF file; it is the
-      result of `create_crop`
+    x0, y0 = max(round(x0), 0), max(round(y0), 0)
+    crop = read_pnm(filepath)[y0:y0 + round(height), x0:x0 + round(width)]
+    levels = get_levels(luma(crop))
+    crops = split_two_side(page_index, last_page, crop) if context.args.two_side else [("", crop)]
+    return [(append_to_path_stem(filepath.with_suffix(".tiff"), suffix), crop.astype(crop.dtype.newbyteorder("=")))
+            for suffix, crop in crops], levels
+
+
+def color_process_single_tiff(context, filepath, pixels, levels, density, mode, suffix):
+    """Applies some colour optimisation and writes the result as a TIFF file
+    with the proper DPI value in its metadata.  Only colour mode with an ICC
+    profile needs external programs, and only then is the crop itself written
+    to a file; everything else is processed in-process with NumPy.  In mono
+    mode, the result is a bilevel TIFF without dithering.
+
+    :param Context context: the state of the scan
+    :param pathlib.Path filepath: TIFF path of the crop as returned by
+      `create_crops`
+    :param numpy.ndarray pixels: pixels of the crop as returned by
+      `create_crops`
+    :param tuple[float, float] levels: black and white levels of the scan area
+      as returned by `create_crops`; they are used in gray_linear and mono mode
     :param float density: DPI of the image
     :param str mode: colour mode; may be the values of the ``--mode`` option
       plus ``gray_linear``, which is used for an OCR-optimised crop
@@ -495,87 +732,71 @@ def color_process_single_tiff(filepath, density, mode, suffix):
     :returns: path to the result image
     :rtype: pathlib.Path
     """
-    tempfile_tiff = append_to_path_stem(filepath, "-temp")
-    if mode == "color" and icc_path:
-        silent_call(["cctiff", "-N", icc_path, filepath, tempfile_tiff])
+    import numpy, tifffile
+    full_histogram = context.args.full_histogram
+    output_filepath = append_to_path_stem(filepath, suffix)
+    if mode == "color" and context.icc_path:
+        tempfile_tiff = append_to_path_stem(filepath, "-temp")
+        tifffile.imwrite(str(filepath), pixels)
+        silent_call(["cctiff", "-N", context.icc_path, filepath, tempfile_tiff])
+        filepath.unlink()
+        silent_call(["convert", tempfile_tiff, "-set", "colorspace", context.icc_color_space, "-colorspace", "RGB"] +
+                    ([] if full_histogram else ["-level", "12.5%,100%"]) +
+                    ["-depth", "8", "-colorspace", "sRGB", "-density", density, output_filepath])
+        tempfile_tiff.unlink()
+    elif mode == "color":
+        pixels = encode_srgb(pixels, 0 if full_histogram else 0.125)
+        tifffile.imwrite(str(output_filepath), pixels, photometric="rgb",
+                         resolution=(density, density), resolutionunit="INCH")
     else:
-        shutil.copy(str(filepath), str(tempfile_tiff))
-    filepath = append_to_path_stem(filepath, suffix)
-    convert_call = ["convert", tempfile_tiff]
-    if mode == "color":
-        convert_call.extend(["-set", "colorspace", icc_color_space, "-colorspace", "RGB"] +
-                            ([] if args.full_histogram else ["-level", "12.5%,100%"]) +
-                            ["-depth", "8", "-colorspace", "sRGB"])
-    elif mode == "gray":
-        convert_call.extend(["-set", "colorspace", "gray"] +
-                            ([] if args.full_histogram else ["-level", "10%,100%"]) +
-                            ["-gamma", "2.2", "-depth", "8"])
-    elif mode == "gray_linear":
-        black, white = get_levels(tempfile_tiff)
-        convert_call.extend(["-set", "colorspace", "gray", "-level", "{}%,{}%".format(black * 100, white * 100),
-                             "-depth", "8"])
-    elif mode == "mono":
-        black, white = get_levels(tempfile_tiff)
-        convert_call.extend(["-set", "colorspace", "gray"] +
-                            ([] if args.full_histogram else ["-level", "{}%,{}%".format((1 - (1 - 0.1) * (1 - black)) * 100,
-                                                                                        0.75 * white * 100)]) +
-                            ["-dither", "None", "-monochrome", "-depth", "1"])
-    convert_call.extend(["-density", density, filepath])
-    silent_call(convert_call)
-    return filepath
-
-
-def split_two_side(page_index, last_page, filepath_tiff, width, height):
-    """Crops the two pages out of the double-page scan.  Note that “width” is the
-    height of the double page page (and thus also of the single page), and
-    “height” is the width of the double page.
-
-    :param int page_index: Index of the current page.  In two-side mode, this
-      is the index of the current double page because separation of left and
-      right happens in this function.
+        pixels = luma(pixels)
+        if mode == "gray":
+            if not full_histogram:
+                pixels = level(pixels, 0.1, 1)
+            pixels = to_8_bit(pixels ** numpy.float32(1 / 2.2))
+        elif mode == "gray_linear":
+            pixels = to_8_bit(level(pixels, *levels))
+        elif mode == "mono":
+            if not full_histogram:
+                black, white = levels
+                pixels = level(pixels, 1 - (1 - 0.1) * (1 - black), 0.75 * white)
+            pixels = pixels >= 0.5
+        tifffile.imwrite(str(output_filepath), pixels, photometric="minisblack",
+                         resolution=(density, density), resolutionunit="INCH")
+    return output_filepath
+
+
+def split_two_side(page_index, last_page, pixels):
+    """Crops the two pages out of the double-page scan.  Note that the width of
+    the pixel array is the height of the double page (and thus also of the
+    single page), and its height is the width of the double page.
+
+    :param int page_index: index of the current double page
     :param bool last_page: whether it is the last page
-    :param filepath_tiff: path to a TIFF with the scan area (i.e., the double
-      page)
-    :type filepath_tiff: pathlib.Path or NoneType
-    :param float width: pixel width of the crop area
-    :param float height: pixel height of the crop area
+    :param numpy.ndarray pixels: the scan area (i.e., the double page)
 
-    :returns: Paths to the two page images, left and right (in this ordering);
-      if it is the first double page, only the right half is returned.  If it
-      is the last double page, only the left half is returned.  Thus, the
-      resulting list either has one or two items.  The list consists of
-      ``None``s if `filepath_tiff` was ``None``.
-    :rtype: list[pathlib.Path] or list[NoneType]
+    :returns: Suffixes for the file names and pixels of the two pages, left and
+      right (in this ordering); if it is the first double page, only the right
+      half is returned.  If it is the last double page, only the left half is
+      returned.  Thus, the resulting list either has one or two items.
+    :rtype: list[tuple[str, numpy.ndarray]]
     """
+    import numpy
     first_page = page_index == 0
     only_one_page = first_page and last_page
     process_left = not first_page or only_one_page
     process_right = not last_page or only_one_page
-    tiff_filepaths = []
-    if filepath_tiff:
-        if process_left:
-            filepath_left_tiff = append_to_path_stem(filepath_tiff, "-0")
-            left = silent_call(["convert", "-extract", "{0}x{1}+0+0".format(width, height / 2), "+repage", filepath_tiff,
-                                "-rotate", "-90", filepath_left_tiff], asynchronous=True)
-        if process_right:
-            filepath_right_tiff = append_to_path_stem(filepath_tiff, "-1")
-            silent_call(["convert", "-extract", "{0}x{1}+0+{1}".format(width, height / 2), "+repage", filepath_tiff,
-                         "-rotate", "-90", filepath_right_tiff])
-        if process_left:
-            assert left.wait() == 0
-            tiff_filepaths.append(filepath_left_tiff)
-        if process_right:
-            tiff_filepaths.append(filepath_right_tiff)
-    else:
-        if process_left:
-            tiff_filepaths.append(None)
-        if process_right:
-            tiff_filepaths.append(None)
-    return tiff_filepaths
+    half = len(pixels) // 2
+    pages = []
+    if process_left:
+        pages.append(("-0", numpy.rot90(pixels[:half])))
+    if process_right:
+        pages.append(("-1", numpy.rot90(pixels[half:2 * half])))
+    return pages
 
 
-def single_page_raw_pdfs(tiff_filepaths, ocr_tiff_filepaths, output_path):
-    """Generates the PDF pairs that are merged to the final pages.  Every page of
+def raw_pdfs(context, tiff_filepaths, ocr_tiff_filepaths, output_path):
+    """Generates the PDF pair that is merged to the final pages.  Every page of
     the final PDF consists of two layers: the invisible text layer and the
     scan.  Here, we generate for a single page, or two pages in two-side mode,
     the input PDFs needed for that.
@@ -583,19 +804,20 @@ def single_page_raw_pdfs(tiff_filepaths, ocr_tiff_filepaths, output_path):
     This means that the input lists either have one or two items.  In the
     latter case, the ordering is left page, right page.  (As a side note, even
     in two-side mode there may be only one item, namely for the first and the
-    last double page.)
+    last double page.)  Both pages end up in the same PDFs, so that Tesseract
+    has to be started only once per double page.  For this, it gets a file
+    with the list of images instead of an image.
 
-    The output tuples contain everything the following code must know, namely
+    The output tuple contains everything the following code must know, namely
     the two input PDFs and the output PDF's name.  The latter is not generated
     here.  This is the task of caller.
 
     By the way, normally, we don't parallelise in function called from
     `process_image` because `process_image` itself is parallelised.  However, I
-    make an exception for the exceptionally expensive Tesseract call.  This is
-    beneficial for the single-page-scan case.  In other cases, at most two
-    Tesseract processes will be spawned here, which should not be a big
-    problem.
+    make an exception for the exceptionally expensive Tesseract call.  It runs
+    while the PDF with the scan is generated.
 
+    :param Context context: the state of the scan
     :param tiff_filepaths: paths to the TIFFs that should form the final PDF
     :param ocr_tiff_filepaths: paths to the TIFFs that are used for OCR (and
       discarded afterwards); may be a list of ``None``s if no OCR is done
@@ -603,24 +825,30 @@ def single_page_raw_pdfs(tiff_filepaths, ocr_tiff_filepaths, output_path):
     :type tiff_filepaths: list[pathlib.Path]
     :type ocr_filepaths: list[pathlib.Path] or list[NoneType]
 
-    :returns: Tuples which contain for each input item the path to the
-      text-only TIFF (the result of the OCR, may be ``None`` if no OCR is
-      done), the path to the PDF with the scan, and the output path for the
-      merged PDF.
-    :rtype: set[tuple[pathlib.Path or NoneType, pathlib.Path, pathlib.Path]]
+    :returns: the path to the text-only PDF (the result of the OCR, may be
+      ``None`` if no OCR is done), the path to the PDF with the scan, and the
+      output path for the merged PDF
+    :rtype: tuple[pathlib.Path or NoneType, pathlib.Path, pathlib.Path]
     """
-    processes = set()
-    result = set()
-    for path, ocr_path in zip(tiff_filepaths, ocr_tiff_filepaths):
-        pdf_filepath = output_path/path.with_suffix(".pdf").name
-        if ocr_path:
-            textonly_pdf_filepath = append_to_path_stem(pdf_filepath, "-textonly")
-            textonly_pdf_pathstem = textonly_pdf_filepath.parent/textonly_pdf_filepath.stem
-            tesseract = silent_call(["tesseract", ocr_path, textonly_pdf_pathstem , "-c", "textonly_pdf=1",
-                                     "-l", args.language, "pdf"], asynchronous=True)
-            processes.add(tesseract)
+    args = context.args
+    path = tiff_filepaths[0]
+    pdf_filepath = output_path/path.with_suffix(".pdf").name
+    if ocr_tiff_filepaths[0]:
+        if len(ocr_tiff_filepaths) == 1:
+            ocr_path = ocr_tiff_filepaths[0]
         else:
-            textonly_pdf_filepath = None
+            ocr_path = path.with_suffix(".txt")
+            ocr_path.write_text("".join(str(ocr_tiff_filepath) + "\n" for ocr_tiff_filepath in ocr_tiff_filepaths))
+        textonly_pdf_filepath = append_to_path_stem(pdf_filepath, "-textonly")
+        textonly_pdf_pathstem = textonly_pdf_filepath.parent/textonly_pdf_filepath.stem
+        # The scans are never inverted and rarely contain tables, so these
+        # extra passes of Tesseract are switched off.
+        tesseract = silent_call(["tesseract", ocr_path, textonly_pdf_pathstem , "-c", "textonly_pdf=1",
+                                 "-c", "tessedit_do_invert=0", "-c", "textord_tabfind_find_tables=0",
+                                 "-l", args.language, "pdf"], asynchronous=True)
+    else:
+        textonly_pdf_filepath = tesseract = None
+    try:
         pdf_image_path = append_to_path_stem(path.with_suffix(".pdf"), "-image")
         if args.mode in {"color", "gray"}:
             if args.quality < 100:
@@ -631,16 +859,46 @@ def single_page_raw_pdfs(tiff_filepaths, ocr_tiff_filepaths, output_path):
             compression_options = ["-compress", "Group4"]
         else:
             compression_options = []
-        silent_call(["convert", path] + compression_options + [pdf_image_path])
-        result.add((textonly_pdf_filepath, pdf_image_path, pdf_filepath))
-    for process in processes:
-        assert process.wait() == 0
-    return result
+        silent_call(["convert"] + tiff_filepaths + compression_options + [pdf_image_path])
+    except BaseException:
+        # Otherwise, Tesseract would go on writing into the temporary
+        # directory of the page while it is removed.
+        if tesseract:
+            tesseract.kill()
+            tesseract.wait()
+        raise
+    if tesseract:
+        if tesseract.wait() != 0:
+            raise subprocess.CalledProcessError(tesseract.returncode, tesseract.args)
+        if ocr_path.suffix == ".txt":
+            ocr_path.unlink()
+    return textonly_pdf_filepath, pdf_image_path, pdf_filepath
+
+
+def add_background(filepath, background_filepath, output_path):
+    """Puts the pages of one PDF underneath the pages of another one.  This is
+    used to combine the text layer of the OCR with the scanned image.  The
+    background pages are embedded as form XObjects, so their content is not
+    re-encoded.
+
+    :param pathlib.Path filepath: path to the PDF with the foreground pages
+    :param pathlib.Path background_filepath: path to the PDF with the
+      background pages
+    :param pathlib.Path output_path: path to the resulting PDF file
+    """
+    import pikepdf
+    with pikepdf.open(filepath) as pdf, pikepdf.open(background_filepath) as background:
+        for page, background_page in zip(pdf.pages, background.pages):
+            page.add_underlay(pdf.copy_foreign(background_page.as_form_xobject()))
+        pdf.save(output_path)
 
 
-def process_image(filepath, page_index, last_page, output_path):
-    """Converts one raw image to a searchable single-page PDF.
+def process_image(context, filepath, page_index, last_page, output_path):
+    """Converts one raw image to a searchable PDF.  It has one page, or two pages
+    in two-side mode.  The intermediate files are written to a temporary
+    directory of their own in the work directory of the context.
 
+    :param Context context: the state of the scan
     :param pathlib.Path filepath: path to the raw image file
     :param int page_index: Index of the current page.  In two-side mode, this
       is the index of the current double page because separation of left and
@@ -648,89 +906,153 @@ def process_image(filepath, page_index, last_page, output_path):
     :param bool last_page: whether it is the last page
     :param pathlib.Path output_path: directory where the PDFs are written to
 
-    :returns: path to the PDF, or the two PDFs in two-side mode
-    :rtype: set[pathlib.Path]
+    :returns: path to the PDF
+    :rtype: list[pathlib.Path]
     """
-    filepath, x0, y0, width, height = raw_to_corrected_pnm(filepath)
-    width, height, density = calculate_pixel_dimensions(width, height)
-    filepath_tiff = create_crop(filepath, width, height, x0, y0)
-    filepath_image_tiff = color_process_single_tiff(filepath_tiff, density, args.mode, "-image")
-    if args.no_ocr:
-        filepath_ocr_tiff = None
-    else:
-        filepath_ocr_tiff = color_process_single_tiff(filepath_tiff, density, "gray_linear", "-ocr")
-    if args.two_side:
-        tiff_filepaths = split_two_side(page_index, last_page, filepath_image_tiff, width, height)
-        ocr_tiff_filepaths = split_two_side(page_index, last_page, filepath_ocr_tiff, width, height)
-    else:
-        tiff_filepaths = [filepath_image_tiff]
-        ocr_tiff_filepaths = [filepath_ocr_tiff]
-    result = set()
-    for textonly_pdf_filepath, pdf_image_path, pdf_filepath in \
-        single_page_raw_pdfs(tiff_filepaths, ocr_tiff_filepaths, output_path):
+    args = context.args
+    with tempfile.TemporaryDirectory(dir=context.work_directory) as work_path:
+        filepath, x0, y0, width, height = raw_to_corrected_pnm(context, filepath, Path(work_path))
+        width, height, density = calculate_pixel_dimensions(context, width, height)
+        crops, levels = create_crops(context, page_index, last_page, filepath, width, height, x0, y0)
+        filepath.unlink()
+        tiff_filepaths, ocr_tiff_filepaths = [], []
+        for filepath_tiff, pixels in crops:
+            tiff_filepaths.append(color_process_single_tiff(context, filepath_tiff, pixels, levels, density, args.mode,
+                                                            "-image"))
+            ocr_tiff_filepaths.append(None if args.no_ocr else
+                                      color_process_single_tiff(context, filepath_tiff, pixels, levels, density,
+                                                                "gray_linear", "-ocr"))
+        del crops, pixels
+        textonly_pdf_filepath, pdf_image_path, pdf_filepath = raw_pdfs(context, tiff_filepaths, ocr_tiff_filepaths,
+                                                                       output_path)
+        for path in tiff_filepaths + ocr_tiff_filepaths:
+            if path:
+                path.unlink()
         if textonly_pdf_filepath:
-            silent_call(["pdftk", textonly_pdf_filepath, "multibackground", pdf_image_path, "output", pdf_filepath])
+            add_background(textonly_pdf_filepath, pdf_image_path, pdf_filepath)
+            textonly_pdf_filepath.unlink()
+            pdf_image_path.unlink()
         else:
             shutil.move(str(pdf_image_path), str(pdf_filepath))
-        result.add(pdf_filepath)
-    return result
+        return [pdf_filepath]
 
 
-def embed_pdf_metadata(filepath):
-    """Embeds metadata in a PDF.  It sets author, creator, title, and timestamp
-    data.  Note that this data is partly taken from the global variables
-    `timestamp` and `title`.  The given file is changed in place.
+def merge_pdfs(context, filepaths, output_path):
+    """Concatenates PDF files and embeds the metadata, see `set_pdf_metadata`.
+    The pages are copied as they are, so their content streams are neither
+    decoded nor re-encoded.  Every file is read as
+    soon as `filepaths` yields it, so the files may still be in the making
+    while the first ones are merged.
 
-    :param pathlib.Path filepath: path to the PDF file
+    :param Context context: the state of the scan
+    :param iterable[pathlib.Path] filepaths: paths to the PDF files, in the
+      order of their pages in the result
+    :param pathlib.Path output_path: path to the resulting PDF file
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        tempdir = Path(tempdir)
-        info_filepath = tempdir/"info.txt"
-        with open(str(info_filepath), "w") as info_file:
-            now = datetime.datetime.now(pytz.utc).astimezone(pytz.timezone("Europe/Amsterdam"))
-            info_file.write("""InfoBegin
-InfoKey: Author
-InfoValue: Torsten Bronger
-InfoBegin
-InfoKey: Creator
-InfoValue: Kamscan
-InfoBegin
-InfoKey: ModDate
-InfoValue: {}
-InfoBegin
-InfoKey: Title
-InfoValue: {}
-""".format(datetime_to_pdf(now), title))
-            if timestamp_accuracy != "none":
-                info_file.write("""InfoBegin
-InfoKey: CreationDate
-InfoValue: {}
-""".format(datetime_to_pdf(timestamp, timestamp_accuracy)))
-        temp_filepath = tempdir/"temp.pdf"
-        silent_call(["pdftk", filepath, "update_info_utf8", info_filepath, "output", temp_filepath])
-        shutil.move(str(temp_filepath), str(filepath))
+    import pikepdf
+    result = pikepdf.Pdf.new()
+    # The source PDFs must stay open until the result is saved.
+    pdfs = []
+    for filepath in filepaths:
+        pdfs.append(pikepdf.open(filepath))
+        result.pages.extend(pdfs[-1].pages)
+    set_pdf_metadata(context, result)
+    result.save(output_path, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    result.close()
+    for pdf in pdfs:
+        pdf.close()
+
+
+def set_pdf_metadata(context, pdf):
+    """Sets the metadata of a PDF.  It sets author, creator, title, and
+    timestamp data.  Note that this data is partly taken from the attributes
+    `timestamp` and `title` of the context.  The PDF must be saved afterwards.
+
+    :param Context context: the state of the scan
+    :param pikepdf.Pdf pdf: the PDF document
+    """
+    import pytz
+    now = datetime.datetime.now(pytz.utc).astimezone(pytz.timezone("Europe/Amsterdam"))
+    pdf.docinfo["/Author"] = "Torsten Bronger"
+    pdf.docinfo["/Creator"] = "Kamscan"
+    pdf.docinfo["/ModDate"] = datetime_to_pdf(now)
+    pdf.docinfo["/Title"] = context.title
+    if context.timestamp_accuracy != "none":
+        pdf.docinfo["/CreationDate"] = datetime_to_pdf(context.timestamp, context.timestamp_accuracy)
 
 
-if __name__ == '__main__':
+def initialize_worker(context):
+    """Initialises a worker process of the page pool.  The context is stored in
+    the worker so that it is not pickled again for every page.
+
+    :param Context context: the state of the scan
+    """
+    global worker_context
+    worker_context = context
+
+
+def process_image_in_worker(filepath, page_index, last_page, output_path):
+    """Calls `process_image` with the context of the worker process.  The
+    parameters and the return value are those of `process_image`.
+    """
+    return process_image(worker_context, filepath, page_index, last_page, output_path)
+
+
+def main():
+    """Scans the document.  The state of the scan is set up from the command line
+    and the configuration, and passed to the worker processes by their
+    initialiser.
+    """
+    try:
+        import argcomplete
+    except ImportError:
+        pass
+    else:
+        argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    utils.debug = args.debug
+    context = Context(args)
+
+    prune_profiles(context.profiles_root)
+    os.makedirs(str(context.profile_root), exist_ok=True)
+
+    if args.calibration:
+        context.correction_data = get_correction_data(context)
+    else:
+        try:
+            context.correction_data = CorrectionData.from_dict(json.loads(context.calibration_file_path.read_text()))
+        except FileNotFoundError:
+            context.correction_data = get_correction_data(context)
+
+    # The PNM of a page has the size of the flat field.  Cropping, colour
+    # processing, and OCR need at most twice as much again.
+    workers = os.cpu_count() or 1
+    context.work_directory = shared_memory_directory(3 * context.flatfield_path.stat().st_size, workers)
+
     start = None
     with tempfile.TemporaryDirectory() as tempdir:
         tempdir = Path(tempdir)
-        pool = multiprocessing.Pool()
-        results = set()
-        for index, last_page, path in source.images(tempdir):
-            if start is None:
-                start = time.time()
-            results.add(pool.apply_async(process_image, (path, index, last_page, tempdir)))
-        print("Rest can be done in background.  You may now press Ctrl-Z and \"bg\" this script.")
-        pool.close()
-        pool.join()
-        pdfs = []
-        for result in results:
-            pdfs.extend(result.get())
-        pdfs.sort()
-        silent_call(["pdftk"] + [pdf for pdf in pdfs] + ["cat", "output", args.filepath])
-        embed_pdf_metadata(args.filepath)
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"),
+                                                    initializer=initialize_worker, initargs=(context,)) as executor:
+            results = []
+            pdfs = []
+            for index, last_page, path in context.source.images(tempdir):
+                if start is None:
+                    start = time.time()
+                if index == 0 and last_page:
+                    # No worker is started for a single page.
+                    pdfs.extend(process_image(context, path, index, last_page, tempdir))
+                else:
+                    results.append(executor.submit(process_image_in_worker, path, index, last_page, tempdir))
+            if results:
+                print("Rest can be done in background.  You may now press Ctrl-Z and \"bg\" this script.")
+            merge_pdfs(context, itertools.chain(pdfs, (pdf for result in results for pdf in result.result())),
+                       args.filepath)
     if args.debug:
         print("Time elapsed in seconds:", time.time() - start)
 
     silent_call(["evince", "--fullscreen", args.filepath])
+
+
+if __name__ == '__main__':
+    main()
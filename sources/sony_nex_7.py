@@ -12,7 +12,7 @@ Example settings::
     reuse_dir_prefix: /tmp/kamscan_nex_7
 """
 
-import time, os, os.path, uuid, datetime
+import time, os, shutil, re, subprocess
 from contextlib import contextmanager
 from pathlib import Path
 from ..utils import silent_call
@@ -20,6 +20,10 @@ from .utils.dcraw import DCRawSource
 from .utils.reuser import Reuser
 
 
+exiv2_line_regex = re.compile(r"(?:(?P<path>.+?)\s+)?Exif\.Photo\.DateTimeOriginal\s+Ascii\s+\d+\s+"
+                              r"(?P<timestamp>\d{4}:\d\d:\d\d \d\d:\d\d:\d\d)\s*$")
+
+
 class Source(DCRawSource, Reuser):
     """Class with abstracts the interface to a Sony NEX-7.
 
@@ -43,18 +47,17 @@ class Source(DCRawSource, Reuser):
         self.paths = None
 
     def _mount_path_exists(self):
-        """Returns whether the mount point of the camera exists.
+        """Returns whether the mount point of the camera exists.  While the
+        storage is being mounted or unmounted, it may not be accessible; then,
+        it counts as not mounted.  The callers poll anyway.
 
         :returns: whether the mount point of the camera exists
         :rtype: bool
         """
-        cycles_left = 5
-        while cycles_left:
-            cycles_left -= 1
-            try:
-                return self.mount_path.exists()
-            except PermissionError as error:
-                time.sleep(1)
+        try:
+            return self.mount_path.is_dir()
+        except PermissionError:
+            return False
 
     @contextmanager
     def _camera_connected(self, wait_for_disconnect=True):
@@ -79,13 +82,58 @@ class Source(DCRawSource, Reuser):
         :returns: all image paths on the camera storage
         :rtype: set[pathlib.Path]
         """
-        result = set()
-        for root, __, filenames in os.walk(str(self.mount_path)):
-            for filename in filenames:
-                if os.path.splitext(filename)[1] in {".JPG", ".ARW"}:
-                    filepath = Path(root)/filename
-                    result.add(filepath)
-        return result
+        def scan(directory):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from scan(entry.path)
+                    elif entry.name.endswith((".JPG", ".ARW")):
+                        yield Path(entry.path)
+        return set(scan(str(self.mount_path)))
+
+    @staticmethod
+    def _timestamps(paths):
+        """Returns the timestamps of images.  They are taken from the Exif data
+        of the images.  If an image does not have a timestamp there, its
+        modification time is used.  The timestamps have the form “2017:09:01
+        14:23:45”, so they sort chronologically as strings.
+
+        :param list[pathlib.Path] paths: paths to the image files
+
+        :returns: the timestamps of the images
+        :rtype: dict[pathlib.Path, str]
+
+        :raises RuntimeError: if the output of exiv2 cannot be assigned to the
+          images
+        """
+        try:
+            output = silent_call(["exiv2", "-g", "Exif.Photo.DateTimeOriginal"] + paths,
+                                 swallow_stdout=False, text=True).stdout
+        except subprocess.CalledProcessError as error:
+            # exiv2 fails for files without Exif data, but still prints the
+            # timestamps of the other ones.
+            output = error.stdout
+        paths_by_name = {str(path): path for path in paths}
+        timestamps = {}
+        for line in output.splitlines():
+            match = exiv2_line_regex.match(line)
+            if not match:
+                continue
+            # For more than one file, exiv2 prefixes every line with the file
+            # name.
+            if len(paths) == 1:
+                path = paths[0]
+            else:
+                path = paths_by_name.get(match.group("path"))
+                if path is None:
+                    raise RuntimeError("exiv2 printed a timestamp for an unknown file: " + line)
+            if path in timestamps:
+                raise RuntimeError("exiv2 printed more than one timestamp for " + str(path))
+            timestamps[path] = match.group("timestamp")
+        for path in paths:
+            if path not in timestamps:
+                timestamps[path] = time.strftime("%Y:%m:%d %H:%M:%S", time.localtime(path.stat().st_mtime))
+        return timestamps
 
     def images(self, tempdir, for_calibration=False):
         """Returns in iterator over the new images on the camera storage.  “New” means
@@ -115,32 +163,18 @@ class Source(DCRawSource, Reuser):
         print("Please take pictures.  Then:")
         with self._camera_connected(wait_for_disconnect=for_calibration):
             paths = self._collect_paths()
-            new_paths = paths - self.paths
-            paths_with_timestamps = []
-            for path in new_paths:
-                output = silent_call(["exiv2", "-g", "Exif.Photo.DateTimeOriginal", path],
-                                     swallow_stdout=False).stdout.strip()
-                paths_with_timestamps.append((datetime.datetime.strptime(output[-19:], "%Y:%m:%d %H:%M:%S"), path))
-            paths_with_timestamps.sort()
-            path_tuples = set()
-            page_count = 0
-            for __, path in paths_with_timestamps:
-                path_tuples.add((path, tempdir/path.name, tempdir/"{:06}.ARW".format(page_count), page_count))
-                page_count += 1
-            rsync = silent_call(["rsync"] + [path[0] for path in path_tuples] + [tempdir], asynchronous=True)
-            raw_paths = set()
-            if not path_tuples:
+            new_paths = list(paths - self.paths)
+            if not new_paths:
                 raise Exception("No images found.")
-            while path_tuples:
-                for path_tuple in path_tuples:
-                    old_path, intermediate_path, destination, page_index = path_tuple
-                    if intermediate_path.exists():
-                        os.rename(str(intermediate_path), str(destination))
-                        raw_paths.add(destination)
-                        os.remove(str(old_path))
-                        path_tuples.remove(path_tuple)
-                        yield page_index, page_index == page_count - 1, destination
-                        break
-            assert rsync.wait() == 0
+            timestamps = self._timestamps(new_paths)
+            paths_with_timestamps = sorted((timestamps[path], path) for path in new_paths)
+            raw_paths = set()
+            page_count = len(paths_with_timestamps)
+            for page_index, (__, path) in enumerate(paths_with_timestamps):
+                destination = tempdir/"{:06}.ARW".format(page_index)
+                shutil.copyfile(str(path), str(destination))
+                raw_paths.add(destination)
+                os.remove(str(path))
+                yield page_index, page_index == page_count - 1, destination
             if not for_calibration:
                 self.fill_reuse_dir(raw_paths)
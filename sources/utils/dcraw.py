@@ -13,7 +13,7 @@ class DCRawSource:
     """
 
     @staticmethod
-    def raw_to_pnm(path, for_preview=False, gray=False, b=None, asynchronous=False):
+    def raw_to_pnm(path, for_preview=False, gray=False, b=None, asynchronous=False, output_directory=None):
         """Calls dcraw to convert a raw image to a PNM file.  In case of `gray`
         being ``False``, it is a PPM file, otherwise, it is a PGM file.  If
         `for_preview` is ``True``, the colour depth is 8 bit, and various
@@ -29,6 +29,11 @@ class DCRawSource:
         :param float b: exposure correction; all intensities are multiplied by this
           value
         :param bool asynchronous: whether to call dcraw asynchronously
+        :param output_directory: directory where the PNM file is written to; if
+          ``None``, it is written next to the raw image file.  Otherwise, a
+          symbolic link to the raw image file is created in this directory.
+
+        :type output_directory: pathlib.Path or NoneType
 
         :returns: output path of the PNM file; if dcraw was called
           asynchronously, the dcraw ``Popen`` object is returned, too
@@ -41,6 +46,11 @@ class DCRawSource:
             dcraw_call.append("-d")
         if b is not None:
             dcraw_call.extend(["-b", b])
+        if output_directory:
+            # dcraw always writes next to its input file.
+            link = output_directory/path.name
+            link.symlink_to(path.resolve())
+            path = link
         dcraw_call.append(path)
         output_path = path.with_suffix(".pgm") if "-d" in dcraw_call else path.with_suffix(".ppm")
         dcraw = silent_call(dcraw_call, asynchronous)
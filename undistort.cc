@@ -4,6 +4,7 @@
    Apply Lensfun corrections to a PNM file in place.  This means, the original
    file is overwritten.  The command line parameters are:
    - path to the PNM file
+   - path to the flat field PNM file
    - x coordinate of top left corner
    - y coordinate of top left corner
    - x coordinate of top right corner
@@ -33,8 +34,10 @@
    Here, x₀ and y₀ are the coordinates of the top left corner, and width and
    height are the dimensions of the rectangle.
 
-   This program does not apply colour corrections such as vignetting
-   correction, as those are handled by kamscan.py using flat field images.
+   Before the geometric corrections, the image is divided by the flat field,
+   which must have the same dimensions and number of channels.  This corrects
+   vignetting, inhomogeneous illumination etc.  Lensfun's own colour
+   corrections such as its vignetting correction are not used.
 */
 #include <Python.h>
 #include <fstream>
@@ -42,6 +45,7 @@
 #include <iterator>
 #include <iostream>
 #include <string>
+#include <sstream>
 #include <algorithm>
 #include <cmath>
 #include "lensfun/lensfun.h"
@@ -84,6 +88,18 @@ public:
         position
     */
     void set(int x, int y, int channel, int value);
+    /** Divide the image by a flat field.  Both are normalised by their maximum
+      colour values before, and the result is clipped to the maximum colour
+      value of this image.  Where the flat field is zero, the result is the
+      maximum colour value.
+      \param flatfield the flat field; it must have the same dimensions and
+        number of channels as this image
+    */
+    void divide(Image &flatfield);
+    /** Determine the maximum colour value.  It is derived from channel_size.
+      \return the maximum colour value
+     */
+    int maximum_value();
     /** Determine the channel descriptions.  This is used by Lensfun internally
       and necessary if you want to apply colour corrections, e.g. vignetting
       correction.
@@ -150,11 +166,33 @@ void Image::set(int x, int y, int channel, int value) {
             data[position] = static_cast<unsigned char>(value);
         else if (channel_size == 2) {
             data[position] = static_cast<unsigned char>(value >> 8);
-            data[position + 1] = static_cast<unsigned char>(value & 256);
+            data[position + 1] = static_cast<unsigned char>(value & 255);
         }
     }
 }
 
+void Image::divide(Image &flatfield) {
+    if (flatfield.width != width || flatfield.height != height || flatfield.channels != channels)
+        throw std::runtime_error("Flat field does not match the image.");
+    const int maximum = maximum_value();
+    const float factor = static_cast<float>(flatfield.maximum_value()) / maximum;
+    for (int y = 0; y < height; y++)
+        for (int x = 0; x < width; x++)
+            for (int channel = 0; channel < channels; channel++) {
+                const int divisor = flatfield.get(x, y, channel);
+                if (divisor == 0)
+                    set(x, y, channel, maximum);
+                else {
+                    const float value = get(x, y, channel) * factor / divisor;
+                    set(x, y, channel, value >= 1 ? maximum : static_cast<int>(std::round(value * maximum)));
+                }
+            }
+}
+
+int Image::maximum_value() {
+    return channel_size == 1 ? 255 : 65535;
+}
+
 int Image::components() {
     switch (channels) {
     case 1:
@@ -203,9 +241,26 @@ std::istream& operator>>(std::istream &inputStream, Image &other)
     size_t size = other.width * other.height * other.channel_size * other.channels;
     other.data.resize(size);
     inputStream.read(reinterpret_cast<char*>(other.data.data()), size);
+    if (!inputStream)
+        throw std::runtime_error("Invalid PPM file: Pixel data is truncated.");
     return inputStream;
 }
 
+/** Reads a PNM file into an image.
+
+  \param filename path to the PNM file
+  \param image the image to read into
+
+  \throws std::runtime_error if the file cannot be opened or is not a valid PNM
+    file
+*/
+static void read_image(const char *filename, Image &image) {
+    std::ifstream file(filename, std::ios::binary);
+    if (!file.good())
+        throw std::runtime_error(std::string("Cannot open ") + filename);
+    file >> image;
+}
+
 std::ostream& operator<<(std::ostream &outputStream, const Image &other)
 {
     outputStream << (other.channels == 3 ? "P6" : "P5") << "\n"
@@ -216,38 +271,95 @@ std::ostream& operator<<(std::ostream &outputStream, const Image &other)
     return outputStream;
 }
 
-static PyObject *undistort(PyObject *self, PyObject *args) {
-    const char *filename, *camera_make, *camera_model, *lens_make, *lens_model;
-    float x0, y0, x1, y1, x2, y2, x3, y3;
-    PyArg_ParseTuple(args, "sffffffffssss", &filename, &x0, &y0, &x1, &y1, &x2, &y2, &x3, &y3,
-                     &camera_make, &camera_model, &lens_make, &lens_model);
+/** Spacing in pixels of the grid on which the undistortion map is stored.  The
+  map is smooth, so it is interpolated bilinearly between the grid points.
+*/
+static const int map_step = 8;
 
-    lfDatabase ldb;
+/** Cache for the undistortion map.  All pages of a scan are taken with the same
+  calibration, so the map is calculated only once per process and then reused
+  for all further pages.  Since it is stored only for every `map_step`-th
+  pixel in both directions, it takes about 9 MB per process for a 24 MP
+  colour image, instead of 576 MB for the full map.
+*/
+static struct {
+    std::string key; ///< all parameters the map depends on, see `map_key`
+    /** for every grid point and channel, its source coordinates in the
+      original image, as returned by Lensfun */
+    std::vector<float> map;
+    int width; ///< number of grid points per row of the map
+    float rectangle[4]; ///< x₀, y₀, width, and height of the rectangle in the output image
+} map_cache;
+
+/** Cache for the flat field.  It is the same for all pages of a scan, so it is
+  read only once per process.  It takes as much memory as the flat field file,
+  i.e. about 144 MB per process for a 24 MP colour image with 16 bits.
+*/
+static struct {
+    std::string filename; ///< path to the flat field file
+    Image image; ///< the flat field
+} flatfield_cache;
+
+/** Lensfun database.  It is loaded only once per process.  It takes a few MB.
+ */
+static lfDatabase *ldb = nullptr;
+
+/** Build the cache key for the undistortion map.
+  \param image the image to be undistorted; only its properties are used
+  \param coordinates the eight corner coordinates
+  \param names camera make, camera model, lens make, and lens model
+  \return the key
+*/
+static std::string map_key(Image &image, const float coordinates[8], const char *names[4]) {
+    std::ostringstream key;
+    key << std::hexfloat << image.width << " " << image.height << " " << image.channels << " "
+        << image.pixel_format();
+    for (int i = 0; i < 8; i++)
+        key << " " << coordinates[i];
+    for (int i = 0; i < 4; i++)
+        key << "\n" << names[i];
+    return key.str();
+}
 
-    if (ldb.Load() != LF_NO_ERROR) {
-        PyErr_SetString(PyExc_RuntimeError, "Database could not be loaded");
-        return NULL;
+/** Calculate the undistortion map and the rectangle in the output image, and
+  store them in `map_cache`.
+  \param image the image to be undistorted; only its properties are used
+  \param coordinates the eight corner coordinates
+  \param names camera make, camera model, lens make, and lens model
+  \return whether it was successful; if not, a Python exception is set
+*/
+static bool calculate_map(Image &image, const float coordinates[8], const char *names[4]) {
+    // Free the old map first, so that it is not kept if this fails.
+    map_cache.key.clear();
+    std::vector<float>().swap(map_cache.map);
+    if (!ldb) {
+        ldb = new lfDatabase;
+        if (ldb->Load() != LF_NO_ERROR) {
+            delete ldb;
+            ldb = nullptr;
+            PyErr_SetString(PyExc_RuntimeError, "Database could not be loaded");
+            return false;
+        }
     }
 
     const lfCamera *camera;
-    const lfCamera **cameras = ldb.FindCamerasExt(camera_make, camera_model);
+    const lfCamera **cameras = ldb->FindCamerasExt(names[0], names[1]);
     if (cameras && !cameras[1])
         camera = cameras[0];
     else {
-        std::vector<char> buffer(std::snprintf(nullptr, 0, "Cannot find unique camera in database.  %i cameras found.",
-                                               (int)sizeof(cameras)));
-        std::snprintf(&buffer[0], buffer.size(), "Cannot find unique camera in database.  %i cameras found.",
-                      (int)sizeof(cameras));
-        // FixMe: Is the second argument really copied on the other side?
-        // Because buffer.data() will be free'ed after the return.
-        PyErr_SetString(PyExc_RuntimeError, buffer.data());
+        int number_of_cameras = 0;
+        if (cameras)
+            while (cameras[number_of_cameras])
+                number_of_cameras++;
+        PyErr_Format(PyExc_RuntimeError, "Cannot find unique camera in database.  %i cameras found.",
+                     number_of_cameras);
         lf_free(cameras);
-        return NULL;
+        return false;
     }
     lf_free(cameras);
 
     const lfLens *lens;
-    const lfLens **lenses = ldb.FindLenses(camera, lens_make, lens_model);
+    const lfLens **lenses = ldb->FindLenses(camera, names[2], names[3]);
     if (lenses) {
         lens = lenses[0];
         if (lenses[1])
@@ -255,47 +367,28 @@ static PyObject *undistort(PyObject *self, PyObject *args) {
     } else {
         PyErr_SetString(PyExc_RuntimeError, "Cannot find lens in database");
         lf_free(lenses);
-        return NULL;
+        return false;
     }
     lf_free(lenses);
 
-    Image image;
-    {
-        std::ifstream file(filename, std::ios::binary);
-        file >> image;
-    }
-
     lfModifier modifier(lens, 50, camera->CropFactor, image.width, image.height, image.pixel_format());
     lfModifier pc_coord_modifier(lens, 50, camera->CropFactor, image.width, image.height, image.pixel_format(), true);
     lfModifier back_modifier(lens, 50, camera->CropFactor, image.width, image.height, image.pixel_format(), true);
     if (!modifier.EnableDistortionCorrection() || !back_modifier.EnableDistortionCorrection() ||
         !pc_coord_modifier.EnableDistortionCorrection()) {
         PyErr_SetString(PyExc_RuntimeError, "Failed to activate undistortion");
-        return NULL;
+        return false;
     }
     if (image.channels == 3)
         if (!modifier.EnableTCACorrection()) {
             PyErr_SetString(PyExc_RuntimeError, "Failed to activate un-TCA");
-            return NULL;
+            return false;
         }
     std::vector<float> x, y;
-    x.push_back(x0);
-    y.push_back(y0);
-
-    x.push_back(x2);
-    y.push_back(y2);
-
-    x.push_back(x1);
-    y.push_back(y1);
-
-    x.push_back(x3);
-    y.push_back(y3);
-
-    x.push_back(x0);
-    y.push_back(y0);
-
-    x.push_back(x1);
-    y.push_back(y1);
+    for (int i : {0, 2, 1, 3, 0, 1}) {
+        x.push_back(coordinates[2 * i]);
+        y.push_back(coordinates[2 * i + 1]);
+    }
     std::vector<float> x_undist, y_undist;
     for (int i = 0; i < x.size(); i++) {
         float result[2];
@@ -306,32 +399,23 @@ static PyObject *undistort(PyObject *self, PyObject *args) {
     if (!modifier.EnablePerspectiveCorrection(x_undist.data(), y_undist.data(), 6, 0) ||
         !back_modifier.EnablePerspectiveCorrection(x_undist.data(), y_undist.data(), 6, 0)) {
         PyErr_SetString(PyExc_RuntimeError, "Failed to activate perspective correction");
-        return NULL;
+        return false;
     }
 
-    std::vector<float> res(image.width * image.height * 2 * image.channels);
-    if (image.channels == 3)
-        modifier.ApplySubpixelGeometryDistortion(0, 0, image.width, image.height, res.data());
-    else
-        modifier.ApplyGeometryDistortion(0, 0, image.width, image.height, res.data());
-    Image new_image = image;
-    for (int x = 0; x < image.width; x++)
-        for (int y = 0; y < image.height; y++) {
-            int position = 2 * image.channels * (y * image.width + x);
-            float source_x_R = res[position];
-            float source_y_R = res[position + 1];
-            new_image.set(x, y, 0, image.get(source_x_R, source_y_R, 0));
-            if (image.channels == 3) {
-                float source_x_G = res[position + 2];
-                float source_y_G = res[position + 3];
-                float source_x_B = res[position + 4];
-                float source_y_B = res[position + 5];
-                new_image.set(x, y, 1, image.get(source_x_G, source_y_G, 1));
-                new_image.set(x, y, 2, image.get(source_x_B, source_y_B, 2));
-            }
+    // The grid reaches at least one step beyond the last pixel, so that every
+    // pixel lies between grid points.
+    const int values = 2 * image.channels;
+    map_cache.width = (image.width - 1) / map_step + 2;
+    const int grid_height = (image.height - 1) / map_step + 2;
+    map_cache.map.resize(map_cache.width * grid_height * values);
+    for (int j = 0; j < grid_height; j++)
+        for (int i = 0; i < map_cache.width; i++) {
+            float *result = &map_cache.map[(j * map_cache.width + i) * values];
+            if (image.channels == 3)
+                modifier.ApplySubpixelGeometryDistortion(i * map_step, j * map_step, 1, 1, result);
+            else
+                modifier.ApplyGeometryDistortion(i * map_step, j * map_step, 1, 1, result);
         }
-    std::ofstream file(filename, std::ios::binary);
-    file << new_image;
 
     for (int i = 0; i < 4; i++) {
         float result[2];
@@ -339,9 +423,75 @@ static PyObject *undistort(PyObject *self, PyObject *args) {
         x[i] = result[0];
         y[i] = result[1];
     }
-    
-    return Py_BuildValue("ffff", std::min(x[0], x[2]), std::min(y[0], y[1]),
-                         std::max(x[1], x[3]) - std::min(x[0], x[2]), std::max(y[2], y[3]) - std::min(y[0], y[1]));
+    map_cache.rectangle[0] = std::min(x[0], x[2]);
+    map_cache.rectangle[1] = std::min(y[0], y[1]);
+    map_cache.rectangle[2] = std::max(x[1], x[3]) - std::min(x[0], x[2]);
+    map_cache.rectangle[3] = std::max(y[2], y[3]) - std::min(y[0], y[1]);
+    map_cache.key = map_key(image, coordinates, names);
+    return true;
+}
+
+static PyObject *undistort(PyObject *self, PyObject *args) {
+    const char *filename, *flatfield_filename;
+    const char *names[4];
+    float coordinates[8];
+    if (!PyArg_ParseTuple(args, "ssffffffffssss", &filename, &flatfield_filename,
+                          &coordinates[0], &coordinates[1], &coordinates[2], &coordinates[3],
+                          &coordinates[4], &coordinates[5], &coordinates[6], &coordinates[7],
+                          &names[0], &names[1], &names[2], &names[3]))
+        return NULL;
+
+    Image image;
+    try {
+        read_image(filename, image);
+        if (flatfield_cache.filename != flatfield_filename) {
+            // Invalidate and free the cache first, in case reading fails
+            // halfway.
+            flatfield_cache.filename.clear();
+            std::vector<unsigned char>().swap(flatfield_cache.image.data);
+            read_image(flatfield_filename, flatfield_cache.image);
+            flatfield_cache.filename = flatfield_filename;
+        }
+        image.divide(flatfield_cache.image);
+    } catch (const std::runtime_error &error) {
+        PyErr_SetString(PyExc_RuntimeError, error.what());
+        return NULL;
+    }
+
+    if (map_cache.key != map_key(image, coordinates, names))
+        if (!calculate_map(image, coordinates, names))
+            return NULL;
+    const int values = 2 * image.channels;
+    const int row_size = map_cache.width * values;
+    // the map interpolated for the current row, at the grid columns
+    std::vector<float> row(row_size);
+
+    Image new_image = image;
+    for (int y = 0; y < image.height; y++) {
+        const float *upper = &map_cache.map[y / map_step * row_size];
+        const float *lower = upper + row_size;
+        const float fraction_y = static_cast<float>(y % map_step) / map_step;
+        for (int k = 0; k < row_size; k++)
+            row[k] = (1 - fraction_y) * upper[k] + fraction_y * lower[k];
+        for (int x = 0; x < image.width; x++) {
+            const float *left = &row[x / map_step * values];
+            const float *right = left + values;
+            const float fraction_x = static_cast<float>(x % map_step) / map_step;
+            float source[6];
+            for (int k = 0; k < values; k++)
+                source[k] = (1 - fraction_x) * left[k] + fraction_x * right[k];
+            new_image.set(x, y, 0, image.get(source[0], source[1], 0));
+            if (image.channels == 3) {
+                new_image.set(x, y, 1, image.get(source[2], source[3], 1));
+                new_image.set(x, y, 2, image.get(source[4], source[5], 2));
+            }
+        }
+    }
+    std::ofstream file(filename, std::ios::binary);
+    file << new_image;
+
+    return Py_BuildValue("ffff", map_cache.rectangle[0], map_cache.rectangle[1],
+                         map_cache.rectangle[2], map_cache.rectangle[3]);
 }
 
 static PyMethodDef UndistortMethods[] = {
@@ -4,7 +4,7 @@ import subprocess, os
 debug = False
 
 
-def silent_call(arguments, asynchronous=False, swallow_stdout=True, timeout=None):
+def silent_call(arguments, asynchronous=False, swallow_stdout=True, timeout=None, pipe_stdin=False, text=False):
     """Calls an external program.  stdout and stderr are swallowed by default.  The
     environment variable ``OMP_THREAD_LIMIT`` is set to one, because we do
     parallelism by ourselves.  In particular, Tesseract scales *very* badly (at
@@ -15,7 +15,12 @@ def silent_call(arguments, asynchronous=False, swallow_stdout=True, timeout=None
     :param bool asynchronous: whether the program should be launched
       asynchronously
     :param bool swallow_stdout: if ``False``, stdout is caught and can be
-      inspected by the caller (as a str rather than a byte string)
+      inspected by the caller (as a byte string, unless “text” is ``True``)
+    :param bool pipe_stdin: if ``True``, stdin is a pipe that can be written to
+      by the caller; only applicable if “asynchronous” is ``True``
+    :param bool text: if ``True``, the pipes to the program are opened in text
+      mode, i.e. they are decoded from and encoded to str; keep it ``False``
+      for image data
     :param timeout: timeout in seconds; only applicable if “asynchronous” is
       ``False``; default: no timeout
 
@@ -31,12 +36,15 @@ def silent_call(arguments, asynchronous=False, swallow_stdout=True, timeout=None
     environment = os.environ.copy()
     environment["OMP_THREAD_LIMIT"] = "1"
     kwargs = {"stdout": subprocess.DEVNULL if swallow_stdout else subprocess.PIPE,
-              "stderr": None if debug else subprocess.DEVNULL, "text": True, "env": environment}
+              "stderr": None if debug else subprocess.DEVNULL, "text": text, "env": environment}
     arguments = list(map(str, arguments))
     if asynchronous:
         assert timeout is None
+        if pipe_stdin:
+            kwargs["stdin"] = subprocess.PIPE
         return subprocess.Popen(arguments, **kwargs)
     else:
+        assert not pipe_stdin
         kwargs["check"] = True
         kwargs["timeout"] = timeout
         return subprocess.run(arguments, **kwargs)